@@ -6,12 +6,13 @@ setuptools.setup(
     packages=['zsec_aws_tools_extensions'],
     install_requires=[
         'boto3',
-        'toolz',
         'attrs',
         'zsec-aws-tools >= 0.1.17',
     ],
+    extras_require={
+        'orjson': ['orjson'],
+    },
     tests_require=[
-        'toolz',
         'pytest',
     ],
     version='0.1.3',
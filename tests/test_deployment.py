@@ -0,0 +1,654 @@
+import json
+import uuid
+from types import MappingProxyType
+from typing import Any, List, Mapping
+
+import attr
+import boto3
+import pytest
+import zsec_aws_tools.aws_lambda
+from botocore.awsrequest import AWSResponse
+from botocore.stub import ANY, Stubber
+
+from zsec_aws_tools_extensions import deployment
+from zsec_aws_tools_extensions.deployment import (
+    PartialAWSResourceCollection, PartialResource, PartialResourceAttribute, collect_garbage,
+    get_latest_layer_version, partial_resources, unmarked, zip_string,
+)
+
+
+class FakeResource:
+    def __init__(self, session=None, region_name=None, ztid=None, name=None, config=None, index_id=None,
+                 manager=None):
+        self.session = session
+        self.region_name = region_name
+        self.ztid = ztid
+        self.name = name
+        self.config = config
+        self.index_id = index_id
+
+
+class StrictList(list):
+    pass
+
+
+def baseline_complete(element, completed: Mapping[uuid.UUID, FakeResource]):
+    """The recursive completion this package shipped with, for comparison."""
+    if isinstance(element, Mapping):
+        return {kk: baseline_complete(vv, completed) for kk, vv in element.items()}
+    elif isinstance(element, List):
+        return [baseline_complete(sub_elt, completed) for sub_elt in element]
+    elif isinstance(element, PartialResource):
+        return completed[element.ztid]
+    elif isinstance(element, PartialResourceAttribute):
+        return lambda _: getattr(completed[element.parent.ztid], element.name)
+    else:
+        return element
+
+
+def resolved(element):
+    """`element` with the attribute resolvers replaced by their values, so that completions can be compared."""
+    if isinstance(element, Mapping):
+        return {kk: resolved(vv) for kk, vv in element.items()}
+    elif isinstance(element, List):
+        return [resolved(sub_elt) for sub_elt in element]
+    elif callable(element):
+        return ('resolved', element(None))
+    else:
+        return element
+
+
+def new_partial(collection, name, config):
+    return collection.new_partial_resource(FakeResource, config, name=name, ztid=uuid.uuid4())
+
+
+def test_complete_passes_kwargs_and_memoizes():
+    collection = PartialAWSResourceCollection()
+    base = new_partial(collection, 'base', {})
+    first = new_partial(collection, 'first', {'base': base, 'name': base.partial_attribute('name')})
+    second = new_partial(collection, 'second', {'base': base, 'name': base.partial_attribute('name')})
+
+    completed = collection.complete(session='session', region_name='us-west-2', manager='manager')
+
+    assert completed[first.ztid].config['base'] is completed[second.ztid].config['base'] is completed[base.ztid]
+    assert completed[first.ztid].config['name'] is completed[second.ztid].config['name']
+    assert completed[first.ztid].config['name'](None) == 'base'
+    assert completed[base.ztid].session == 'session'
+    assert completed[base.ztid].region_name == 'us-west-2'
+
+
+def test_attribute_resolvers_are_bound_per_completion():
+    collection = PartialAWSResourceCollection()
+    base = new_partial(collection, 'base', {})
+    dependent = new_partial(collection, 'dependent', {'region': base.partial_attribute('region_name')})
+
+    east = collection.complete(session=None, region_name='us-east-1')
+    west = collection.complete(session=None, region_name='us-west-2')
+
+    assert east[dependent.ztid].config['region'](None) == 'us-east-1'
+    assert west[dependent.ztid].config['region'](None) == 'us-west-2'
+
+
+def test_complete_detects_cycles():
+    collection = PartialAWSResourceCollection()
+    config = {}
+    aa = new_partial(collection, 'a', config)
+    bb = new_partial(collection, 'b', {'a': aa})
+    config['b'] = bb
+
+    with pytest.raises(ValueError):
+        collection.complete(session=None)
+
+
+def test_topological_order():
+    collection = PartialAWSResourceCollection()
+    dd = collection.new_partial_resource(FakeResource, None, name='d', ztid=uuid.uuid4())
+    aa = new_partial(collection, 'a', {})
+    cc = new_partial(collection, 'c', {'a': aa, 'names': [dd.partial_attribute('name')]})
+    bb = new_partial(collection, 'b', {'c': cc, 'a': aa})
+
+    order = collection.topological_order()
+
+    assert set(order) == {aa, bb, cc, dd}
+    assert order.index(aa) < order.index(cc) < order.index(bb)
+    assert order.index(dd) < order.index(cc)
+    # completed, and so later applied, in that order too
+    names = [resource.name for resource in collection.complete(session=None)]
+    assert names.index('a') < names.index('c') < names.index('b')
+
+
+def test_topological_waves():
+    collection = PartialAWSResourceCollection()
+    aa = new_partial(collection, 'a', {})
+    bb = new_partial(collection, 'b', {})
+    cc = new_partial(collection, 'c', {'a': aa, 'b': [bb.partial_attribute('name')]})
+    dd = new_partial(collection, 'd', {'c': cc, 'a': aa})
+
+    assert collection.topological_waves() == [[aa, bb], [cc], [dd]]
+    assert collection.topological_order() == [aa, bb, cc, dd]
+
+    completed = collection.complete(session=None)
+    assert [[resource.name for resource in wave] for wave in completed.dependency_waves()] == [['a', 'b'], ['c'], ['d']]
+
+
+def test_topological_waves_detects_cycles():
+    collection = PartialAWSResourceCollection()
+    config = {}
+    aa = new_partial(collection, 'a', config)
+    bb = new_partial(collection, 'b', {'a': aa})
+    config['b'] = bb
+    new_partial(collection, 'independent', {})
+
+    with pytest.raises(ValueError, match='cyclic dependency among'):
+        collection.topological_waves()
+
+
+def test_collections_are_looked_up_by_ztid():
+    collection = PartialAWSResourceCollection()
+    aa = new_partial(collection, 'a', {})
+    missing = uuid.uuid4()
+
+    assert aa.ztid in collection and missing not in collection
+    # equal, but not the same, UUID
+    assert collection[uuid.UUID(str(aa.ztid))] is aa
+    assert collection.get(missing) is None
+
+    completed = collection.complete(session=None)
+    assert aa.ztid in completed and missing not in completed
+    assert completed[aa.ztid].name == 'a'
+    assert completed.get(missing, 'default') == 'default'
+
+
+def test_complete_matches_baseline():
+    collection = PartialAWSResourceCollection()
+    base = new_partial(collection, 'base', {'Arn': 'arn:base', 'tags': [1, 2]})
+    shared = {'ref': base, 'plain': [1, {'x': 'y'}]}
+    dependent = new_partial(collection, 'dependent', {
+        'proxy': MappingProxyType({'parent': base, 'n': 2}),
+        'subclassed': StrictList([base.partial_attribute('name'), 3]),
+        'first': shared,
+        'second': shared,
+        'untouched': {'k': [True, None, 1.5]},
+    })
+
+    completed = collection.complete(session=None)
+    by_ztid = {resource.ztid: resource for resource in completed}
+    config = by_ztid[dependent.ztid].config
+
+    assert resolved(config) == resolved(baseline_complete(dependent.config, by_ztid))
+    assert list(config) == list(dependent.config)
+    assert config['proxy']['parent'] is by_ztid[base.ztid]
+    assert type(config['proxy']) is dict
+    assert type(config['subclassed']) is list
+    assert config['subclassed'][0](None) == 'base'
+    # a container referenced twice is completed once
+    assert config['first'] is config['second']
+    # the partial config is left as it was
+    assert dependent.config['first']['ref'] is base
+
+
+def test_completed_configs_are_independent():
+    collection = PartialAWSResourceCollection()
+    base = new_partial(collection, 'base', {})
+    template = {'tags': {'team': 'a'}, 'subnets': ['s0'], 'base': base}
+    first = new_partial(collection, 'first', template)
+    second = new_partial(collection, 'second', template)
+
+    completed = collection.complete(session=None)
+    config = completed[first.ztid].config
+    config['tags']['team'] = 'b'
+    config['subnets'].append('s1')
+    config['extra'] = True
+
+    assert template == {'tags': {'team': 'a'}, 'subnets': ['s0'], 'base': base}
+    assert completed[second.ztid].config == {'tags': {'team': 'a'}, 'subnets': ['s0'], 'base': completed[base.ztid]}
+
+
+def test_complete_dependents_handles_deep_configs():
+    collection = PartialAWSResourceCollection()
+    base = new_partial(collection, 'base', {})
+    completed = collection.complete(session=None)
+    deep = leaf = {}
+    for _ in range(5000):
+        leaf['nested'] = {}
+        leaf = leaf['nested']
+    leaf['ref'] = base
+
+    element = base.complete_dependents(completed, deep)
+    while 'nested' in element:
+        element = element['nested']
+    assert element['ref'] is completed[base.ztid]
+
+
+def test_complete_handles_deep_configs():
+    collection = PartialAWSResourceCollection()
+    base = new_partial(collection, 'base', {})
+    deep = leaf = {}
+    for _ in range(5000):
+        leaf['nested'] = [{}]
+        leaf = leaf['nested'][0]
+    leaf['ref'] = base
+    dependent = new_partial(collection, 'dependent', deep)
+
+    completed = collection.complete(session=None)
+    element = completed[dependent.ztid].config
+    while 'nested' in element:
+        element = element['nested'][0]
+    assert element['ref'] is completed[base.ztid]
+
+
+def test_partial_generic_resource_completes_args_once():
+    collection = PartialAWSResourceCollection()
+    base = new_partial(collection, 'base', {})
+    calls = []
+
+    @partial_resources(uuid.uuid4(), base, name=base.partial_attribute('name'))
+    def generic(resource, name):
+        calls.append((resource, name(None)))
+
+    collection.append(generic)
+    completed = collection.complete(session=None)
+    # the arguments were completed along with the generic resource, before it is put
+    assert base.ztid in completed
+
+    completed[generic.ztid].put()
+    completed[generic.ztid].put()
+    assert calls == [(completed[base.ztid], 'base')] * 2
+
+
+def test_element_kinds_are_cached_per_type():
+    class Proxy(dict):
+        pass
+
+    assert Proxy not in deployment._ELEMENT_KINDS
+    assert deployment._element_kind(Proxy) == deployment._MAPPING
+    assert deployment._ELEMENT_KINDS[Proxy] == deployment._MAPPING
+    assert deployment._element_kind(MappingProxyType) == deployment._MAPPING
+    assert deployment._element_kind(StrictList) == deployment._LIST
+    assert deployment._element_kind(PartialResource) == deployment._PARTIAL_RESOURCE
+    assert deployment._element_kind(PartialResourceAttribute) == deployment._PARTIAL_ATTRIBUTE
+    assert deployment._element_kind(deployment.PartialGenericResource) == deployment._PARTIAL_GENERIC_RESOURCE
+    assert deployment._element_kind(bool) == deployment._SCALAR
+    assert deployment._element_kind(tuple) == deployment._OTHER
+
+
+def test_resources_are_slotted():
+    collection = PartialAWSResourceCollection()
+    base = new_partial(collection, 'base', {})
+    generic = partial_resources(uuid.uuid4(), base)(lambda resource: None)
+    collection.append(generic)
+    completed = collection.complete(session=None)
+
+    for instance in base, base.partial_attribute('name'), generic, completed[generic.ztid], collection, completed:
+        assert not hasattr(instance, '__dict__'), type(instance)
+
+
+def test_get_latest_layer_version_is_cached_per_layer():
+    client = boto3.session.Session().client('lambda', region_name='us-east-1',
+                                            aws_access_key_id='testing', aws_secret_access_key='testing')
+    layer_arn = 'arn:aws:lambda:us-east-1:123456789000:layer:{}'
+    get_latest_layer_version.cache_clear()
+    with Stubber(client) as stubber:
+        for layer_name in 'first', 'second':
+            stubber.add_response('list_layer_versions', {'LayerVersions': [
+                {'LayerVersionArn': layer_arn.format(layer_name) + ':3', 'Version': 3}]},
+                {'LayerName': layer_name, 'MaxItems': 1})
+
+        try:
+            for _ in range(2):
+                assert get_latest_layer_version(client, 'first') == layer_arn.format('first') + ':3'
+                assert get_latest_layer_version(client, LayerName='second') == layer_arn.format('second') + ':3'
+        finally:
+            get_latest_layer_version.cache_clear()
+        stubber.assert_no_pending_responses()
+
+
+def test_zip_string_is_cached():
+    source = f'# {uuid.uuid4()}\ndef handler(event, context):\n    return event\n'
+
+    assert zip_string(source) is zip_string(source)
+    assert zip_string.__wrapped__ is zsec_aws_tools.aws_lambda.zip_string
+
+
+def test_partial_resources_hash_like_their_ztid():
+    collection = PartialAWSResourceCollection()
+    base = new_partial(collection, 'base', {})
+    without_ztid = PartialResource(FakeResource, {})
+
+    assert hash(base) == hash(base.ztid)
+    assert hash(without_ztid) == hash(None)
+
+
+def test_partial_generic_resource_is_frozen_and_hashable():
+    ztid = uuid.uuid4()
+    generic = partial_resources(ztid)(lambda: None)
+    twin = partial_resources(ztid)(lambda: None)
+
+    assert hash(generic) == hash(twin) == hash(ztid.int)
+    # equality is identity
+    assert len({generic, twin, generic}) == 2
+    with pytest.raises(attr.exceptions.FrozenInstanceError):
+        generic.name = 'renamed'
+
+
+# Stubbed DynamoDB responses are in the low level format, but the expected parameters are the table's, since the
+# stubber checks them before boto3 serializes them.
+
+def record(zrn, dependency_order, ztid=None, account_number='123456789000'):
+    return {
+        'zrn': {'S': zrn},
+        'account_number': {'S': account_number},
+        'region_name': {'S': 'us-east-1'},
+        'type': {'S': f'{FakeResource.__module__}.{FakeResource.__name__}'},
+        'ztid': {'S': ztid or zrn},
+        'index_id': {'NULL': True},
+        'dependency_order': {'N': str(dependency_order)},
+    }
+
+
+@pytest.fixture
+def table(monkeypatch):
+    dynamodb = boto3.session.Session().resource('dynamodb', region_name='us-east-1',
+                                                aws_access_key_id='testing', aws_secret_access_key='testing')
+    # sessions for the profiles named in records
+    monkeypatch.setattr(boto3, 'Session', lambda profile_name: 'session:' + profile_name)
+    deployment._session_for_profile.cache_clear()
+    yield dynamodb.Table('resources_by_zrn')
+    deployment._session_for_profile.cache_clear()
+
+
+@pytest.fixture
+def stubber(table):
+    with Stubber(table.meta.client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def scan_params(**extra):
+    return dict(TableName='resources_by_zrn', FilterExpression=ANY, ConsistentRead=True,
+                ProjectionExpression=ANY, ExpressionAttributeNames=ANY, **extra)
+
+
+def test_unmarked_shares_a_session_per_profile(table, stubber, monkeypatch):
+    profile_names = []
+
+    def new_session(profile_name):
+        profile_names.append(profile_name)
+        return 'session:' + profile_name
+
+    monkeypatch.setattr(boto3, 'Session', new_session)
+    stubber.add_response('scan', {'Items': [record('z0', 0), record('z2', 2, account_number='000000000000'),
+                                            record('z1', 1)]}, scan_params())
+    stubber.add_response('scan', {'Items': [record('z3', 3)]}, scan_params())
+
+    found = list(unmarked(table, {'manager': 'manager'}, uuid.uuid4(), high_to_low_dependency_order=True))
+    # a later scan in the same process
+    found.extend(unmarked(table, {'manager': 'manager'}, uuid.uuid4(), high_to_low_dependency_order=True))
+
+    assert [(dependency_order, zrn) for dependency_order, zrn, _ in found] == [
+        (2, 'z2'), (1, 'z1'), (0, 'z0'), (3, 'z3')]
+    resources = [resource for _, _, resource in found]
+    assert all(isinstance(resource, FakeResource) for resource in resources)
+    assert [resource.session for resource in resources] == [
+        'session:000000000000', 'session:123456789000', 'session:123456789000', 'session:123456789000']
+    assert sorted(profile_names) == ['000000000000', '123456789000']
+    assert (resources[0].region_name, resources[0].ztid) == ('us-east-1', 'z2')
+
+
+def test_unmarked_scans_every_page(table, stubber):
+    stubber.add_response('scan', {'Items': [record('z0', 0), record('z2', 2), record('z1', 1)],
+                                  'LastEvaluatedKey': {'zrn': {'S': 'z1'}}}, scan_params())
+    stubber.add_response('scan', {'Items': [record('z1b', 1)]},
+                         scan_params(ExclusiveStartKey={'zrn': 'z1'}))
+
+    found = unmarked(table, {'manager': 'manager'}, uuid.uuid4(), high_to_low_dependency_order=False)
+
+    # ties stay in the order they were read
+    assert [(dependency_order, zrn) for dependency_order, zrn, _ in found] == [
+        (0, 'z0'), (1, 'z1'), (1, 'z1b'), (2, 'z2')]
+
+
+def query_params(**extra):
+    return dict(TableName='resources_by_zrn', IndexName='by_manager', KeyConditionExpression=ANY,
+                FilterExpression=ANY, ProjectionExpression=ANY, ExpressionAttributeNames=ANY, **extra)
+
+
+def get_item_params(zrn):
+    return dict(TableName='resources_by_zrn', Key={'zrn': zrn}, ConsistentRead=True,
+                ProjectionExpression=ANY, ExpressionAttributeNames=ANY)
+
+
+def test_unmarked_queries_index_and_rereads(table, stubber):
+    deployment_id = uuid.uuid4()
+    marked = {**record('z1', 1), 'deployment_id': {'S': str(deployment_id)}}
+
+    stubber.add_response('query', {'Items': [{'zrn': {'S': 'z0'}}, {'zrn': {'S': 'z1'}}],
+                                   'LastEvaluatedKey': {'zrn': {'S': 'z1'}}}, query_params())
+    stubber.add_response('get_item', {'Item': record('z0', 0)}, get_item_params('z0'))
+    # marked since the index was last updated
+    stubber.add_response('get_item', {'Item': marked}, get_item_params('z1'))
+    stubber.add_response('query', {'Items': [{'zrn': {'S': 'z2'}}, {'zrn': {'S': 'z3'}}]},
+                         query_params(ExclusiveStartKey={'zrn': 'z1'}))
+    stubber.add_response('get_item', {'Item': record('z2', 2)}, get_item_params('z2'))
+    # deleted since the index was last updated
+    stubber.add_response('get_item', {}, get_item_params('z3'))
+
+    found = unmarked(table, {'manager': 'manager'}, deployment_id, high_to_low_dependency_order=False,
+                     index_name='by_manager')
+
+    assert [zrn for _, zrn, _ in found] == ['z0', 'z2']
+
+
+def test_unmarked_streams_ordered_index(table, stubber):
+    stubber.add_response('query', {'Items': [{'zrn': {'S': 'z2'}}, {'zrn': {'S': 'z1'}}],
+                                   'LastEvaluatedKey': {'zrn': {'S': 'z1'}}},
+                         query_params(ScanIndexForward=False))
+    stubber.add_response('get_item', {'Item': record('z2', 2)}, get_item_params('z2'))
+
+    found = unmarked(table, {'manager': 'manager'}, uuid.uuid4(), high_to_low_dependency_order=True,
+                     index_name='by_manager', index_ordered=True)
+
+    # yielded before the second page is read
+    assert next(found)[1] == 'z2'
+
+    stubber.add_response('get_item', {'Item': record('z1', 1)}, get_item_params('z1'))
+    # z2 is read again, after its dependency_order was changed meanwhile, and is skipped
+    stubber.add_response('query', {'Items': [{'zrn': {'S': 'z2'}}, {'zrn': {'S': 'z0'}}]},
+                         query_params(ScanIndexForward=False, ExclusiveStartKey={'zrn': 'z1'}))
+    stubber.add_response('get_item', {'Item': record('z0', 0)}, get_item_params('z0'))
+
+    assert [zrn for _, zrn, _ in found] == ['z1', 'z0']
+
+
+def matches(condition, item) -> bool:
+    """Evaluates a condition built from `boto3.dynamodb.conditions.Attr` against `item`."""
+    expression = condition.get_expression()
+    operator, values = expression['operator'], expression['values']
+    if operator == 'AND':
+        return all(matches(value, item) for value in values)
+    elif operator == 'NOT':
+        return not matches(values[0], item)
+    elif operator == '=':
+        attribute, value = values
+        return item.get(attribute.name) == value
+    else:
+        raise NotImplementedError(operator)
+
+
+def test_build_filter():
+    scope_items = (('account', 'a'), ('manager', 'm'))
+    condition = deployment._build_filter('d1', scope_items)
+
+    assert deployment._build_filter('d1', scope_items) is condition
+    assert matches(condition, {'deployment_id': 'd0', 'account': 'a', 'manager': 'm'})
+    assert matches(condition, {'account': 'a', 'manager': 'm'})
+    assert not matches(condition, {'deployment_id': 'd1', 'account': 'a', 'manager': 'm'})
+    assert not matches(condition, {'deployment_id': 'd0', 'account': 'b', 'manager': 'm'})
+    assert not matches(condition, {'deployment_id': 'd0', 'account': 'a'})
+    assert matches(deployment._build_filter('d1', ()), {'deployment_id': 'd0'})
+
+
+def and_depth(condition) -> int:
+    """Depth of the `And` nodes in `condition`."""
+    expression = condition.get_expression()
+    if expression['operator'] != 'AND':
+        return 0
+    return 1 + max(map(and_depth, expression['values']))
+
+
+def test_build_filter_is_balanced():
+    scope_items = tuple((f'key{nn}', f'value{nn}') for nn in range(7))
+    item = {kk: vv for kk, vv in scope_items}
+    condition = deployment._build_filter('d1', scope_items)
+
+    # eight clauses
+    assert and_depth(condition) == 3
+    assert matches(condition, item)
+    for kk, _ in scope_items:
+        assert not matches(condition, {**item, kk: 'other'})
+    assert not matches(condition, {**item, 'deployment_id': 'd1'})
+
+
+def test_collect_garbage_deletes_tiers_from_high_to_low(table, stubber, monkeypatch):
+    deleted = []
+    monkeypatch.setattr(deployment, '_delete_resource', lambda resource: deleted.append(resource.ztid))
+
+    stubber.add_response('scan', {'Items': [record('z0', 0), record('z1', 1), record('z1b', 1)]}, scan_params())
+    # one batch per tier
+    stubber.add_response('batch_write_item', {'UnprocessedItems': {}}, {'RequestItems': {'resources_by_zrn': [
+        {'DeleteRequest': {'Key': {'zrn': 'z1'}}}, {'DeleteRequest': {'Key': {'zrn': 'z1b'}}},
+    ]}})
+    stubber.add_response('batch_write_item', {'UnprocessedItems': {}}, {'RequestItems': {'resources_by_zrn': [
+        {'DeleteRequest': {'Key': {'zrn': 'z0'}}},
+    ]}})
+
+    collect_garbage(table, {'manager': 'manager'}, uuid.uuid4(), max_marked_dependency_order=5, dry=False,
+                    max_workers=2)
+
+    assert sorted(deleted[:2]) == ['z1', 'z1b']
+    assert deleted[2:] == ['z0']
+
+
+def test_collect_garbage_stops_after_a_failed_tier(table, stubber, monkeypatch):
+    deleted = []
+
+    def delete_resource(resource):
+        if resource.ztid == 'z1b':
+            raise RuntimeError('delete failed')
+        deleted.append(resource.ztid)
+
+    monkeypatch.setattr(deployment, '_delete_resource', delete_resource)
+
+    stubber.add_response('scan', {'Items': [record('z0', 0), record('z1', 1), record('z1b', 1)]}, scan_params())
+    # only the record of the resource that was deleted
+    stubber.add_response('batch_write_item', {'UnprocessedItems': {}}, {'RequestItems': {'resources_by_zrn': [
+        {'DeleteRequest': {'Key': {'zrn': 'z1'}}},
+    ]}})
+
+    with pytest.raises(RuntimeError, match='delete failed'):
+        collect_garbage(table, {'manager': 'manager'}, uuid.uuid4(), max_marked_dependency_order=5, dry=False,
+                        max_workers=1)
+
+    assert deleted == ['z1']
+
+
+class RawBody:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+@pytest.fixture
+def wire(table):
+    """
+    Answers the table's requests from `responses`, a mapping of operation name to low level responses, and records
+    the serialized requests, so that tests can check what is actually sent.
+    """
+    sent = []
+    responses = {}
+
+    def before_send(request, **kwargs):
+        operation = request.headers['X-Amz-Target'].decode().split('.')[-1]
+        sent.append((operation, json.loads(request.body)))
+        return AWSResponse(request.url, 200, {}, RawBody(json.dumps(responses[operation].pop(0)).encode()))
+
+    table.meta.client.meta.events.register('before-send.dynamodb', before_send)
+    yield sent, responses
+    assert not any(responses.values())
+
+
+def test_collect_garbage_sends_string_keys(table, wire, monkeypatch):
+    sent, responses = wire
+    monkeypatch.setattr(deployment, '_delete_resource', lambda resource: None)
+    responses['Scan'] = [{'Items': [record('z0', 0)]}]
+    responses['BatchWriteItem'] = [{'UnprocessedItems': {}}]
+
+    collect_garbage(table, {'manager': 'manager'}, uuid.uuid4(), max_marked_dependency_order=5, dry=False)
+
+    assert sent[-1] == ('BatchWriteItem', {'RequestItems': {'resources_by_zrn': [
+        {'DeleteRequest': {'Key': {'zrn': {'S': 'z0'}}}}]}})
+
+
+@attr.s(auto_attribs=True)
+class FakeRole:
+    service_client: Any
+    name: str = 'role'
+
+
+@pytest.fixture
+def iam():
+    client = boto3.session.Session().client('iam', region_name='us-east-1', aws_access_key_id='testing',
+                                            aws_secret_access_key='testing')
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def policy_arn(name):
+    return f'arn:aws:iam::aws:policy/{name}'
+
+
+def test_parallel_detach_policies_removes_managed_and_inline_policies(iam):
+    client, stubber = iam
+    # two pages of managed policies
+    stubber.add_response('list_attached_role_policies', {
+        'AttachedPolicies': [{'PolicyName': 'first', 'PolicyArn': policy_arn('first')}],
+        'IsTruncated': True, 'Marker': 'marker',
+    }, {'RoleName': 'role'})
+    stubber.add_response('list_attached_role_policies', {
+        'AttachedPolicies': [{'PolicyName': 'second', 'PolicyArn': policy_arn('second')}],
+        'IsTruncated': False,
+    }, {'RoleName': 'role', 'Marker': 'marker'})
+    stubber.add_response('list_role_policies', {'PolicyNames': ['inline'], 'IsTruncated': False},
+                         {'RoleName': 'role'})
+    # a single worker keeps the calls in the order they are stubbed
+    stubber.add_response('detach_role_policy', {}, {'RoleName': 'role', 'PolicyArn': policy_arn('first')})
+    # detached meanwhile
+    stubber.add_client_error('detach_role_policy', 'NoSuchEntity', http_status_code=404,
+                             expected_params={'RoleName': 'role', 'PolicyArn': policy_arn('second')})
+    stubber.add_response('delete_role_policy', {}, {'RoleName': 'role', 'PolicyName': 'inline'})
+
+    deployment.parallel_detach_policies(FakeRole(client), max_workers=1)
+
+
+def test_parallel_detach_policies_skips_missing_roles(iam):
+    client, stubber = iam
+    stubber.add_client_error('list_attached_role_policies', 'NoSuchEntity', http_status_code=404,
+                             expected_params={'RoleName': 'role'})
+
+    deployment.parallel_detach_policies(FakeRole(client))
+
+
+def test_parallel_detach_policies_raises_other_errors(iam):
+    client, stubber = iam
+    stubber.add_response('list_attached_role_policies', {'AttachedPolicies': [], 'IsTruncated': False},
+                         {'RoleName': 'role'})
+    stubber.add_response('list_role_policies', {'PolicyNames': ['inline'], 'IsTruncated': False},
+                         {'RoleName': 'role'})
+    stubber.add_client_error('delete_role_policy', 'AccessDenied', http_status_code=403,
+                             expected_params={'RoleName': 'role', 'PolicyName': 'inline'})
+
+    with pytest.raises(client.exceptions.ClientError, match='AccessDenied'):
+        deployment.parallel_detach_policies(FakeRole(client))
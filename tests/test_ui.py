@@ -0,0 +1,353 @@
+import json
+import logging
+import sys
+import time
+import uuid
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from zsec_aws_tools_extensions import ui
+from zsec_aws_tools_extensions.deployment import PartialAWSResourceCollection
+
+
+class FakeResource:
+    def __init__(self, session=None, region_name=None, ztid=None, name=None, config=None, index_id=None,
+                 manager=None, log=None):
+        self.session = session
+        self.region_name = region_name
+        self.ztid = ztid
+        self.name = name
+        self.config = config
+        self.index_id = index_id
+        self.exists = False
+        self.log = log
+
+    def put(self, force=False):
+        self.log.append(('put', self.name))
+        self.exists = True
+
+    def delete(self):
+        self.log.append(('delete', self.name))
+        self.exists = False
+
+
+def completed_collection(log, session=None):
+    """a and b, then c, which depends on both, then d, which depends on c."""
+    collection = PartialAWSResourceCollection()
+
+    def new_partial(name, config):
+        return collection.new_partial_resource(FakeResource, config, name=name, ztid=uuid.uuid4(), log=log)
+
+    aa = new_partial('a', {'x': 1})
+    bb = new_partial('b', {'x': 1})
+    cc = new_partial('c', {'a': aa, 'b': bb})
+    new_partial('d', {'c': cc})
+    return collection.complete(session=session)
+
+
+def names(log, action):
+    return [name for logged_action, name in log if logged_action == action]
+
+
+def handle_cli_command(monkeypatch, *args, argv, **kwargs):
+    monkeypatch.setattr(sys, 'argv', ['deploy.py', *argv])
+    ui.handle_cli_command('manager', *args, **kwargs)
+
+
+class Recorder:
+    """Stands in for the Lambda `FunctionResource` that writes resource records."""
+
+    def __init__(self, exists=True):
+        self.exists = exists
+        self.payloads = []
+
+    def invoke(self, json_codec=False, **kwargs):
+        assert json_codec
+        self.payloads.append(kwargs['Payload'])
+
+
+@pytest.fixture
+def account_ids(monkeypatch):
+    """Sessions that `get_account_id` was called with, which returns the same account id for all of them."""
+    lookups = []
+
+    def get_account_id(session):
+        lookups.append(session)
+        return '123456789000'
+
+    monkeypatch.setattr(ui, 'get_account_id', get_account_id)
+    # records are only built for AWSResources
+    monkeypatch.setattr(ui, 'AWSResource', FakeResource)
+    ui._account_id_for.cache_clear()
+    yield lookups
+    ui._account_id_for.cache_clear()
+
+
+def test_meta_description_looks_up_account_once_per_session(account_ids):
+    sessions = object(), object()
+    ztid = uuid.uuid4()
+    resources = [FakeResource(session=session, region_name='us-east-1', ztid=ztid, name='name')
+                 for session in sessions for _ in range(2)]
+
+    descriptions = [ui.get_resource_meta_description(resource) for resource in resources]
+
+    assert account_ids == list(sessions)
+    assert descriptions[0] == {
+        'zrn': f'zrn:aws:123456789000:us-east-1:{ztid}',
+        'account_number': '123456789000',
+        'region_name': 'us-east-1',
+        'ztid': str(ztid),
+        'name': 'name',
+        'index_id': None,
+        'type': f'{FakeResource.__module__}.FakeResource',
+    }
+
+
+def test_put_resource_nice_records_the_resource(account_ids):
+    recorder = Recorder()
+    deployment_id = uuid.uuid4()
+    resource = FakeResource(session='session', region_name='us-east-1', ztid=uuid.uuid4(), name='name',
+                            config={'x': 1}, log=[])
+
+    ui.put_resource_nice('manager', resource, dependency_order=3, force=False, put_resource_record=recorder,
+                         deployment_id=deployment_id)
+
+    assert resource.log == [('put', 'name')]
+    assert recorder.payloads == [{
+        **ui.get_resource_meta_description(resource),
+        'deployment_id': str(deployment_id),
+        'manager': 'manager',
+        'dependency_order': 3,
+    }]
+
+
+def test_apply_runs_waves_in_order(monkeypatch):
+    log = []
+    collection = completed_collection(log)
+
+    handle_cli_command(monkeypatch, collection, argv=['apply'])
+
+    applied = names(log, 'put')
+    assert sorted(applied[:2]) == ['a', 'b']
+    assert applied[2:] == ['c', 'd']
+
+
+def test_destroy_runs_waves_in_reverse(monkeypatch):
+    log = []
+    collection = completed_collection(log)
+    for resource in collection:
+        resource.exists = True
+
+    handle_cli_command(monkeypatch, collection, argv=['destroy'])
+
+    destroyed = names(log, 'delete')
+    assert destroyed[:2] == ['d', 'c']
+    assert sorted(destroyed[2:]) == ['a', 'b']
+
+
+def test_plain_iterables_are_applied_one_at_a_time(monkeypatch):
+    log = []
+    resources = [FakeResource(name=name, ztid=uuid.uuid4(), config={'x': 1}, log=log) for name in 'cab']
+
+    handle_cli_command(monkeypatch, iter(resources), argv=['apply'])
+
+    assert names(log, 'put') == ['c', 'a', 'b']
+
+
+def test_account_ids_are_looked_up_once_per_session(monkeypatch, account_ids):
+    log = []
+    session = object()
+    collection = completed_collection(log, session=session)
+    recorder = Recorder()
+    running = []
+
+    def get_account_id(session_):
+        running.append(session_)
+        # give the other worker of the wave time to miss the cache too
+        time.sleep(0.05)
+        assert running == [session_], 'concurrent lookups'
+        running.pop()
+        account_ids.append(session_)
+        return '123456789000'
+
+    monkeypatch.setattr(ui, 'get_account_id', get_account_id)
+
+    handle_cli_command(monkeypatch, collection, put_resource_record=recorder, argv=['apply'])
+
+    assert account_ids == [session]
+    assert sorted((payload['name'], payload['dependency_order']) for payload in recorder.payloads) == [
+        ('a', 0), ('b', 0), ('c', 1), ('d', 2)]
+    assert {payload['account_number'] for payload in recorder.payloads} == {'123456789000'}
+
+
+@pytest.mark.parametrize('recorder', [None, Recorder(exists=False)])
+def test_account_ids_are_not_looked_up_without_a_recorder(monkeypatch, account_ids, recorder):
+    collection = completed_collection([], session=object())
+
+    handle_cli_command(monkeypatch, collection, put_resource_record=recorder, argv=['apply'])
+
+    assert account_ids == []
+
+
+def test_only_ztids_selects_resources(monkeypatch):
+    log = []
+    resources = [FakeResource(name=name, ztid=uuid.uuid4(), config={'x': 1}, log=log) for name in 'abc']
+
+    handle_cli_command(monkeypatch, resources,
+                       argv=['apply', '--only-ztids', str(resources[2].ztid), str(resources[0].ztid)])
+
+    assert names(log, 'put') == ['a', 'c']
+
+
+def test_only_ztids_skips_resources_without_a_ztid(monkeypatch):
+    log = []
+    collection = PartialAWSResourceCollection()
+    anonymous = collection.new_partial_resource(FakeResource, {'x': 1}, name='anonymous', log=log)
+    named = collection.new_partial_resource(FakeResource, {'anonymous': anonymous}, name='named', ztid=uuid.uuid4(),
+                                            log=log)
+    completed = collection.complete(session=None)
+
+    handle_cli_command(monkeypatch, completed, argv=['apply', '--only-ztids', str(named.ztid)])
+
+    assert names(log, 'put') == ['named']
+
+
+def test_argv_is_parsed_instead_of_sys_argv(monkeypatch):
+    log = []
+    resources = [FakeResource(name='a', ztid=uuid.uuid4(), config={'x': 1}, log=log)]
+    monkeypatch.setattr(sys, 'argv', ['deploy.py', 'destroy'])
+
+    ui.handle_cli_command('manager', resources, argv=['apply'])
+
+    assert names(log, 'put') == ['a']
+
+
+def test_dedup_keeps_the_last_resource_per_ztid(monkeypatch):
+    log = []
+    ztid = uuid.uuid4()
+    resources = [FakeResource(name=name, ztid=ztid_, config={'x': 1}, log=log)
+                 for name, ztid_ in [('first', ztid), ('anonymous', None), ('other', uuid.uuid4()),
+                                     ('anonymous', None), ('last', ztid)]]
+
+    handle_cli_command(monkeypatch, resources, dedup=True, argv=['apply'])
+
+    assert names(log, 'put') == ['last', 'anonymous', 'other', 'anonymous']
+
+
+def test_known_account_number_is_not_looked_up(monkeypatch, account_ids):
+    collection = completed_collection([], session=object())
+    recorder = Recorder()
+
+    handle_cli_command(monkeypatch, collection, put_resource_record=recorder, account_number='210987654321',
+                       argv=['apply'])
+
+    assert account_ids == []
+    assert len(recorder.payloads) == 4
+    for payload in recorder.payloads:
+        assert payload['account_number'] == '210987654321'
+        assert payload['zrn'] == f'zrn:aws:210987654321:None:{payload["ztid"]}'
+
+
+class LambdaRecorder:
+    """A recorder whose `invoke` goes to a stubbed Lambda client, like `FunctionResource.invoke` without a codec."""
+
+    exists = True
+    name = 'recorder'
+
+    def __init__(self, client):
+        self.client = client
+
+    def invoke(self, json_codec=False, **kwargs):
+        assert not json_codec
+        return self.client.invoke(FunctionName=self.name, **kwargs)
+
+
+def test_records_are_queued_with_record_async(account_ids):
+    client = boto3.session.Session().client('lambda', region_name='us-east-1', aws_access_key_id='testing',
+                                            aws_secret_access_key='testing')
+    deployment_id = uuid.uuid4()
+    resource = FakeResource(session='session', region_name='us-east-1', ztid=uuid.uuid4(), name='name',
+                            config={'x': 1}, log=[])
+    payload = {
+        **ui.get_resource_meta_description(resource),
+        'deployment_id': str(deployment_id),
+        'manager': 'manager',
+        'dependency_order': 3,
+    }
+
+    with Stubber(client) as stubber:
+        stubber.add_response('invoke', {'StatusCode': 202}, {
+            'FunctionName': 'recorder', 'InvocationType': 'Event', 'Payload': ui._dumps(payload)})
+        ui.put_resource_nice('manager', resource, dependency_order=3, force=False,
+                             put_resource_record=LambdaRecorder(client), deployment_id=deployment_id,
+                             record_async=True)
+        stubber.assert_no_pending_responses()
+
+
+def test_record_async_refuses_garbage_collection(monkeypatch):
+    log = []
+    collection = completed_collection(log)
+
+    with pytest.raises(ValueError, match='garbage collection'):
+        handle_cli_command(monkeypatch, collection, support_gc=True, record_async=True, argv=['apply'])
+    assert log == []
+
+
+@pytest.mark.parametrize('dumps', [
+    ui._json_dumps,
+    pytest.param(getattr(ui.orjson, 'dumps', None), id='orjson',
+                 marks=pytest.mark.skipif(ui.orjson is None, reason='orjson is not installed')),
+])
+def test_payloads_are_encoded_to_json_bytes(dumps):
+    payload = {'zrn': 'zrn:aws:123456789000:us-east-1:ztid', 'dependency_order': 3, 'index_id': None}
+
+    encoded = dumps(payload)
+
+    assert isinstance(encoded, bytes)
+    assert json.loads(encoded) == payload
+
+
+@pytest.fixture
+def package_logger(monkeypatch):
+    """
+    The package logger, without a level. Tests cut it off from the handlers that pytest attaches to the root and to
+    non-propagating loggers with `cut_off`, since those are attached after the fixtures are set up.
+    """
+    package_logger = logging.getLogger('zsec_aws_tools_extensions')
+    level = package_logger.level
+    package_logger.setLevel(logging.NOTSET)
+    yield package_logger
+    package_logger.setLevel(level)
+
+
+def cut_off(monkeypatch, logger: logging.Logger):
+    monkeypatch.setattr(logger, 'propagate', False)
+    monkeypatch.setattr(logger, 'handlers', [])
+
+
+def test_cli_prints_progress_without_logging_config(monkeypatch, package_logger, capsys):
+    cut_off(monkeypatch, package_logger)
+    resources = [FakeResource(name='a', ztid=uuid.uuid4(), config={'x': 1}, log=[])]
+
+    handle_cli_command(monkeypatch, resources, argv=['apply'])
+    handle_cli_command(monkeypatch, resources, argv=['apply'])
+
+    assert len(package_logger.handlers) == 1
+    assert capsys.readouterr().out.splitlines() == [
+        f'applying: a(ztid={resources[0].ztid}) : FakeResource', 'gc not supported, skipping'] * 2
+
+
+def test_cli_leaves_configured_logging_alone(monkeypatch, package_logger, capsys):
+    cut_off(monkeypatch, package_logger)
+    handler = logging.NullHandler()
+    package_logger.addHandler(handler)
+    package_logger.setLevel(logging.WARNING)
+
+    handle_cli_command(monkeypatch, [FakeResource(name='a', ztid=uuid.uuid4(), config={'x': 1}, log=[])],
+                       argv=['apply'])
+
+    assert package_logger.handlers == [handler]
+    assert package_logger.level == logging.WARNING
+    assert capsys.readouterr().out == 'gc not supported, skipping\n'
@@ -1,55 +1,93 @@
+import collections.abc
+import heapq
+import importlib
 import logging
-import textwrap
-from functools import partial
-from operator import getitem, itemgetter
-from types import MappingProxyType
+from collections import defaultdict
+from concurrent.futures import FIRST_EXCEPTION, Executor, Future, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
+from itertools import groupby
+from operator import itemgetter
 
 import attr
 import boto3
-import zipfile
+from boto3.dynamodb.conditions import Attr, Key
 import uuid
 import abc
-import toolz
-from toolz import curried
-from zsec_aws_tools.aws_lambda import zip_string
+from zsec_aws_tools.aws_lambda import zip_string as _zip_string
 import zsec_aws_tools.iam as zaws_iam
-from typing import Iterable, Callable, Mapping, Generator, Any, List, Tuple, Union, Dict, Optional
+from typing import Iterable, Iterator, Callable, Mapping, Generator, Any, List, Tuple, Union, Dict, Optional, Set
 
 from zsec_aws_tools.basic import AWSResource
 
 logger = logging.getLogger(__name__)
 
+# Lambda sources are often shared boilerplate, so reuse the archive instead of compressing identical code again.
+zip_string = lru_cache(maxsize=512)(_zip_string)
+
+
+def ztid_key(ztid: Optional[uuid.UUID]) -> Optional[int]:
+    """Key used for `ztid` in the collections' dicts; hashing the int skips `UUID.__hash__`."""
+    return None if ztid is None else ztid.int
+
 
 class AWSResourceCollection(Iterable):
+    __slots__ = ('_resources', '_in_progress', '_attribute_resolvers', '_dependency_orders')
+
     def __init__(self):
+        # Keyed by `ztid_key(ztid)`.
         self._resources = {}
+        # keys of partial resources whose completion has started but not finished; used to detect cycles.
+        self._in_progress = set()
+        # (parent key, attribute name) -> resolver returned by `PartialResourceAttribute.complete`
+        self._attribute_resolvers = {}
+        # key -> index of the wave of `PartialAWSResourceCollection.topological_waves` that the resource came from
+        self._dependency_orders = {}
 
     def append(self, resource: AWSResource):
-        self._resources[resource.ztid] = resource
+        self._resources[ztid_key(resource.ztid)] = resource
 
     def extend(self, resources: Iterable[AWSResource]):
         for resource in resources:
             self.append(resource)
 
-    def __iter__(self):
-        yield from self._resources.values()
+    def __iter__(self) -> Iterator['CompleteResource']:
+        return iter(self._resources.values())
+
+    def __contains__(self, key):
+        return ztid_key(key) in self._resources
 
     def __getitem__(self, key):
-        return self._resources[key]
+        return self._resources[ztid_key(key)]
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+        return self._resources.get(ztid_key(key), default)
 
     def __setitem__(self, key, value):
-        self._resources[key] = value
+        self._resources[ztid_key(key)] = value
+
+    def dependency_waves(self) -> List[List['CompleteResource']]:
+        """
+        Returns the resources grouped into waves, such that resources only depend on resources in earlier waves.
+
+        The waves are those of `PartialAWSResourceCollection.topological_waves` if every resource came from
+        `PartialAWSResourceCollection.complete`; otherwise each resource is in its own wave, in insertion order.
+        """
+        orders = self._dependency_orders
+        if any(key not in orders for key in self._resources):
+            return [[resource] for resource in self]
+
+        waves = defaultdict(list)
+        for key, resource in self._resources.items():
+            waves[orders[key]].append(resource)
+        return [waves[order] for order in sorted(waves)]
 
 
 class GenericResource:
+    __slots__ = ('ztid', '_ztid_int', 'name', 'fn', 'exists')
+
     def __init__(self, ztid, name, fn):
         self.ztid = ztid
+        self._ztid_int = ztid_key(ztid)
         self.name = name
         self.fn = fn
         self.exists = False
@@ -65,29 +103,48 @@ CompleteResource = Union[GenericResource, AWSResource]
 
 
 class PartialResourceABC(abc.ABC):
+    __slots__ = ()
+
     ztid: uuid.UUID
 
     def complete(self, collection: 'AWSResourceCollection', **kwargs) -> CompleteResource:
         ...
 
+    def _dependencies(self) -> Iterable['PartialResourceABC']:
+        """Partial resources that must be completed before this one."""
+        return ()
 
-@attr.s(auto_attribs=True)
+
+@attr.s(auto_attribs=True, slots=True, frozen=True, eq=False, hash=False)
 class PartialGenericResource(PartialResourceABC):
     ztid: uuid.UUID
     name: str
     fn: Callable
     args: Iterable[PartialResourceABC]
     kwargs: Mapping[Any, PartialResourceABC]
+    _ztid_int: Optional[int] = attr.ib(init=False, repr=False)
+
+    @_ztid_int.default
+    def _ztid_int_default(self):
+        return ztid_key(self.ztid)
 
     def complete(self, collection: 'AWSResourceCollection', **kwargs) -> CompleteResource:
-        completed_args = (arg.complete(collection, **kwargs) for arg in self.args)
+        # Completed eagerly, so that the thunk sees the same arguments however many times it is called.
+        completed_args = tuple(arg.complete(collection, **kwargs) for arg in self.args)
         completed_kwargs = {kk: vv.complete(collection, **kwargs) for kk, vv in self.kwargs.items()}
 
-        def thunk():
-            return self.fn(*completed_args, **completed_kwargs)
+        def thunk(_fn=self.fn, _args=completed_args, _kwargs=completed_kwargs):
+            return _fn(*_args, **_kwargs)
 
         return GenericResource(self.ztid, self.name, thunk)
 
+    def _dependencies(self) -> Iterable[PartialResourceABC]:
+        yield from _iter_partial_dependencies(list(self.args))
+        yield from _iter_partial_dependencies(list(self.kwargs.values()))
+
+    def __hash__(self):
+        return hash(self._ztid_int)
+
 
 def partial_resources(ztid, *args: PartialResourceABC, **kwargs):
     def _inner1(fn):
@@ -98,6 +155,8 @@ def partial_resources(ztid, *args: PartialResourceABC, **kwargs):
 
 
 class PartialResourceAttribute:
+    __slots__ = ('parent', 'name')
+
     parent: 'PartialResource'
     name: str
 
@@ -106,17 +165,73 @@ class PartialResourceAttribute:
         self.name = name
 
     def complete(self, collection: 'AWSResourceCollection', **kwargs) -> Any:
-        if self.parent.ztid not in collection:
-            collection[self.parent.ztid] = self.parent.complete(collection, **kwargs)
+        key = (self.parent._ztid_int, self.name)
+        resolver = collection._attribute_resolvers.get(key)
+        if resolver is None:
+            parent = self.parent.complete(collection, **kwargs)
 
-        # the lambda is to make sure it only gets evaluated when processing config.
-        return lambda _: getattr(collection[self.parent.ztid], self.name)
+            # the lambda is to make sure it only gets evaluated when processing config.
+            resolver = collection._attribute_resolvers[key] = lambda _, _parent=parent, _name=self.name: getattr(
+                _parent, _name)
+        return resolver
+
+
+# types of config values that are never containers or partial resources
+_SCALAR_TYPES = frozenset((str, int, float, bool, type(None)))
+
+# kinds of config elements, as classified by `_element_kind`
+_SCALAR, _MAPPING, _LIST, _PARTIAL_RESOURCE, _PARTIAL_GENERIC_RESOURCE, _PARTIAL_ATTRIBUTE, _OTHER = range(7)
+
+# type -> kind of its instances; `_element_kind` adds the types not listed here on first sight
+_ELEMENT_KINDS: Dict[type, int] = {**dict.fromkeys(_SCALAR_TYPES, _SCALAR), dict: _MAPPING, list: _LIST}
+
+
+def _element_kind(element_type: type) -> int:
+    """
+    Classifies instances of `element_type` for the config walkers. The subclass checks against the ABCs are done
+    once per type, so most elements are classified with a single dict lookup.
+    """
+    kind = _ELEMENT_KINDS.get(element_type)
+    if kind is None:
+        if issubclass(element_type, collections.abc.Mapping):
+            kind = _MAPPING
+        elif issubclass(element_type, list):
+            kind = _LIST
+        elif issubclass(element_type, PartialResource):
+            kind = _PARTIAL_RESOURCE
+        elif issubclass(element_type, PartialResourceABC):
+            kind = _PARTIAL_GENERIC_RESOURCE
+        elif issubclass(element_type, PartialResourceAttribute):
+            kind = _PARTIAL_ATTRIBUTE
+        else:
+            kind = _OTHER
+        _ELEMENT_KINDS[element_type] = kind
+    return kind
+
+
+def _iter_partial_dependencies(element) -> Generator[PartialResourceABC, None, None]:
+    """Yields the partial resources referenced directly (not transitively) in `element`."""
+    stack = [element]
+    while stack:
+        element = stack.pop()
+        kind = _element_kind(type(element))
+        if kind == _MAPPING:
+            # reversed, so that dependencies are yielded in the order they appear
+            stack.extend(reversed(list(element.values())))
+        elif kind == _LIST:
+            stack.extend(reversed(element))
+        elif kind == _PARTIAL_RESOURCE or kind == _PARTIAL_GENERIC_RESOURCE:
+            yield element
+        elif kind == _PARTIAL_ATTRIBUTE:
+            yield element.parent
 
 
 class PartialResource(PartialResourceABC):
     """
     if config is None, then
     """
+    __slots__ = ('type_', 'name', 'ztid', '_ztid_int', 'kwargs', 'config', 'index_id')
+
     ztid: uuid.UUID
     type_: type
 
@@ -125,49 +240,97 @@ class PartialResource(PartialResourceABC):
         self.type_ = type_
         self.name = name
         self.ztid = ztid
+        self._ztid_int = ztid_key(ztid)
         self.kwargs = kwargs
         self.config = config
         self.index_id = index_id
 
     def complete_dependents(self, collection: AWSResourceCollection, element, **kwargs) -> Any:
-        if isinstance(element, Mapping):
-            completed = {}
-            for kk, vv in element.items():
-                completed[kk] = self.complete_dependents(collection, vv, **kwargs)
-            return completed
-        elif isinstance(element, List):
-            completed = []
-            for sub_elt in element:
-                completed.append(self.complete_dependents(collection, sub_elt, **kwargs))
-            return completed
-        elif isinstance(element, PartialResource):
-            if element.ztid not in collection:
-                collection[element.ztid] = element.complete(collection, **kwargs)
-            return collection[element.ztid]
-        elif isinstance(element, PartialResourceAttribute):
-            return element.complete(collection, **kwargs)
-        else:
-            return element
+        """
+        Returns a copy of `element` with the partial resources referenced in it replaced by their completions.
+
+        Nested mappings and lists are walked with an explicit stack instead of recursion, so deeply nested configs
+        cannot hit the recursion limit. Every mapping and list is copied, including those without partial resources,
+        so that a resource may modify its config in place without affecting the partial config or other resources.
+        A container referenced more than once in `element` is walked and copied once, and every reference gets that
+        copy.
+        """
+        kind_of = _element_kind
+        scalar_types = _SCALAR_TYPES
+        completed = collection._resources
+
+        # id of copied container -> copy, so that a container referenced more than once is completed once
+        copies = {}
+
+        root = [None]
+        # (output container, key in output container, element to complete into it)
+        stack = [(root, 0, element)]
+        while stack:
+            container, key, element = stack.pop()
+            kind = kind_of(type(element))
+            if kind == _SCALAR:
+                container[key] = element
+            elif id(element) in copies:
+                container[key] = copies[id(element)]
+            elif kind == _MAPPING:
+                # Scalars, the bulk of most configs, are copied over here rather than going through the stack.
+                out = container[key] = copies[id(element)] = dict(element.items())
+                # reversed, so that elements are completed in their original order
+                stack.extend((out, kk, vv) for kk, vv in reversed(out.items()) if type(vv) not in scalar_types)
+            elif kind == _LIST:
+                out = container[key] = copies[id(element)] = list(element)
+                stack.extend((out, ii, sub_elt) for ii, sub_elt in reversed(list(enumerate(out)))
+                             if type(sub_elt) not in scalar_types)
+            elif kind == _PARTIAL_RESOURCE:
+                existing = completed.get(element._ztid_int)
+                container[key] = element.complete(collection, **kwargs) if existing is None else existing
+            elif kind == _PARTIAL_ATTRIBUTE:
+                container[key] = element.complete(collection, **kwargs)
+            else:
+                container[key] = element
+
+        return root[0]
 
     def complete(self, collection: AWSResourceCollection, **kwargs) -> AWSResource:
-        core_kwargs: Dict[str, Any]
-        core_kwargs = dict(name=self.name, ztid=self.ztid)
-        if self.config is not None:
-            core_kwargs['config'] = self.complete_dependents(collection, element=self.config, **kwargs)
+        """Completes this resource, or returns the memoized result if it is already in `collection`."""
+        key = self._ztid_int
+        completed = collection._resources
+        existing = completed.get(key)
+        if existing is not None:
+            return existing
+        if key in collection._in_progress:
+            raise ValueError(f'cyclic dependency detected at: {self.name}(ztid={self.ztid})')
+
+        collection._in_progress.add(key)
+        try:
+            combined_kwargs: Dict[str, Any]
+            combined_kwargs = {**kwargs, 'name': self.name, 'ztid': self.ztid}
+            if self.config is not None:
+                combined_kwargs['config'] = self.complete_dependents(collection, element=self.config, **kwargs)
+        finally:
+            collection._in_progress.discard(key)
+
+        combined_kwargs.update(self.kwargs)
 
-        combined_kwargs = toolz.merge(kwargs, core_kwargs, self.kwargs)
+        resource = completed[key] = self.type_(**combined_kwargs)
+        return resource
 
-        return self.type_(**combined_kwargs)
+    def _dependencies(self) -> Iterable[PartialResourceABC]:
+        return _iter_partial_dependencies(self.config)
 
     def __hash__(self):
-        return hash(self.ztid)
+        # Same value as `hash(self.ztid)`, which is `hash(self.ztid.int)`, without the `UUID.__hash__` call.
+        return hash(self._ztid_int)
 
     def partial_attribute(self, name):
         return PartialResourceAttribute(self, name)
 
 
 class PartialAWSResourceCollection(Iterable):
-    _resources: Dict[uuid.UUID, PartialResource]
+    __slots__ = ('_resources',)
+
+    # Keyed by `ztid_key(ztid)`.
+    _resources: Dict[Optional[int], PartialResource]
 
     def __init__(self):
         self._resources = {}
@@ -180,24 +343,84 @@ class PartialAWSResourceCollection(Iterable):
         return resource
 
     def append(self, resource: PartialResource):
-        assert resource.ztid not in self._resources
-        self._resources[resource.ztid] = resource
+        key = ztid_key(resource.ztid)
+        assert key not in self._resources
+        self._resources[key] = resource
 
     def extend(self, resources: Iterable[PartialResource]):
         for resource in resources:
             self.append(resource)
 
-    def __iter__(self) -> Generator[PartialResource, None, None]:
-        yield from self._resources.values()
+    def __iter__(self) -> Iterator[PartialResource]:
+        return iter(self._resources.values())
+
+    def __contains__(self, key):
+        return ztid_key(key) in self._resources
 
     def __getitem__(self, key):
-        return self._resources[key]
+        return self._resources[ztid_key(key)]
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+        return self._resources.get(ztid_key(key), default)
+
+    def topological_waves(self) -> List[List[PartialResourceABC]]:
+        """
+        Returns the resources in this collection, and the partial resources they reference, in waves: each resource
+        is in the wave right after the last of its dependencies (Kahn's algorithm, breadth first). The resources
+        within a wave are independent of each other.
+
+        :raises ValueError: if there is a dependency cycle.
+        """
+        # all keyed by `ztid_key(ztid)`
+        nodes: Dict[Optional[int], PartialResourceABC] = {}
+        remaining: Dict[Optional[int], Set[Optional[int]]] = {}
+        dependents: Dict[Optional[int], List[Optional[int]]] = defaultdict(list)
+
+        for root in self:
+            to_visit = [root]
+            while to_visit:
+                node = to_visit.pop()
+                key = ztid_key(node.ztid)
+                if key in nodes:
+                    continue
+                nodes[key] = node
+                remaining[key] = deps = set()
+                for dep in node._dependencies():
+                    dep_key = ztid_key(dep.ztid)
+                    if dep_key not in deps:
+                        deps.add(dep_key)
+                        dependents[dep_key].append(key)
+                        to_visit.append(dep)
+
+        waves = []
+        n_ordered = 0
+        wave = [key for key, deps in remaining.items() if not deps]
+        while wave:
+            waves.append([nodes[key] for key in wave])
+            n_ordered += len(wave)
+            next_wave = []
+            for key in wave:
+                for dependent in dependents[key]:
+                    deps = remaining[dependent]
+                    deps.discard(key)
+                    if not deps:
+                        next_wave.append(dependent)
+            wave = next_wave
+
+        if n_ordered < len(nodes):
+            cyclic = ', '.join(f'{nodes[key].name}(ztid={nodes[key].ztid})' for key, deps in remaining.items() if deps)
+            raise ValueError(f'cyclic dependency among: {cyclic}')
+
+        return waves
+
+    def topological_order(self) -> List[PartialResourceABC]:
+        """
+        Returns the resources in this collection, and the partial resources they reference, ordered so that every
+        resource comes after its dependencies.
+
+        :raises ValueError: if there is a dependency cycle.
+        """
+        return [node for wave in self.topological_waves() for node in wave]
 
     def complete(self, session: boto3.Session, region_name: str = None, manager: str = None) -> AWSResourceCollection:
         completed_collection = AWSResourceCollection()
@@ -208,71 +431,244 @@ class PartialAWSResourceCollection(Iterable):
         if manager:
             kwargs['manager'] = manager
 
-        for partial_resource in self:
-            if partial_resource.ztid not in completed_collection:
-                if isinstance(partial_resource, (PartialResource, PartialGenericResource)):
-                    completed_collection[partial_resource.ztid] = partial_resource.complete(
-                        completed_collection, **kwargs)
+        # Dependencies come first, so each resource is completed exactly once, with its dependencies already in
+        # `completed_collection`.
+        for dependency_order, wave in enumerate(self.topological_waves()):
+            for partial_resource in wave:
+                if partial_resource.ztid not in completed_collection:
+                    if isinstance(partial_resource, (PartialResource, PartialGenericResource)):
+                        completed_collection[partial_resource.ztid] = partial_resource.complete(
+                            completed_collection, **kwargs)
+                        completed_collection._dependency_orders[ztid_key(partial_resource.ztid)] = dependency_order
 
         return completed_collection
 
 
+@lru_cache(maxsize=256)
 def get_latest_layer_version(client, LayerName: str):
-    """Returns the latest version of an AWS Lambda layer."""
-    return max(
-        client.list_layer_versions(LayerName=LayerName)['LayerVersions'],
-        key=lambda x: x['Version']
-    )['LayerVersionArn']
+    """
+    Returns the latest version of an AWS Lambda layer.
 
+    Results are cached per `(client, LayerName)`; call `get_latest_layer_version.cache_clear()` after publishing a
+    new version of a layer that was already looked up.
+    """
+    # versions are listed newest first
+    return client.list_layer_versions(LayerName=LayerName, MaxItems=1)['LayerVersions'][0]['LayerVersionArn']
 
-def deserialize_resource(session, region_name, type: str, ztid, index_id):
-    import importlib
 
-    module_name = '.'.join(type.split('.')[:-1])
-    leaf_name = type.split('.')[-1]
+@lru_cache(maxsize=None)
+def _load_type(type: str) -> type:
+    """Returns the class named by the dotted path `type`, importing its module if needed."""
+    module_name, leaf_name = type.rsplit('.', 1)
 
     module = importlib.import_module(module_name)
 
-    _type = getattr(module, leaf_name)
+    return getattr(module, leaf_name)
+
+
+def deserialize_resource(session, region_name, type: str, ztid, index_id):
+    _type = _load_type(type)
 
     return _type(session=session, region_name=region_name, ztid=ztid, index_id=index_id)
 
 
+def _paginate(method: Callable, **kwargs) -> Generator[Dict[str, Any], None, None]:
+    """Yields the items from every page of a DynamoDB table `scan` or `query`."""
+    while True:
+        response = method(**kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# attributes of a resource record that are needed to deserialize and collect it
+_RECORD_ATTRIBUTES = ('zrn', 'account_number', 'region_name', 'type', 'ztid', 'index_id', 'dependency_order')
+
+
+def _projection(attributes: Iterable[str]) -> Dict[str, Any]:
+    """Request parameters reading only `attributes`. Built fresh each call, since boto3 adds to the names mapping."""
+    attributes = tuple(attributes)
+    return dict(ProjectionExpression=', '.join('#' + aa for aa in attributes),
+                ExpressionAttributeNames={'#' + aa: aa for aa in attributes})
+
+
+def _get_unmarked_item(resources_by_zrn_table, zrn: str, deployment_id_str: str) -> Optional[Dict[str, Any]]:
+    """Strongly consistent read of the record for `zrn`; `None` if it is gone or marked with `deployment_id_str`."""
+    item = resources_by_zrn_table.get_item(Key={'zrn': zrn}, ConsistentRead=True,
+                                           **_projection(_RECORD_ATTRIBUTES + ('deployment_id',))).get('Item')
+    if item is not None and item.get('deployment_id') != deployment_id_str:
+        return item
+
+
+def _reread_candidates(resources_by_zrn_table, candidates: Iterable[Dict[str, Any]],
+                       deployment_id_str: str) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily re-reads the records of `candidates` (items with a `zrn`) with `_get_unmarked_item`, skipping the ones
+    that turn out to be marked.
+
+    A candidate is only re-read once, even if it is read from the index again: updating a record's `dependency_order`
+    while an index ordered by it is paged through can move the record past the page being read.
+    """
+    seen = set()
+    for candidate in candidates:
+        zrn = candidate['zrn']
+        if zrn not in seen:
+            seen.add(zrn)
+            item = _get_unmarked_item(resources_by_zrn_table, zrn, deployment_id_str)
+            if item is not None:
+                yield item
+
+
+def _by_dependency_order(items: Iterable[Dict[str, Any]], high_to_low: bool) -> Iterator[Dict[str, Any]]:
+    """Yields `items` ordered by `dependency_order`, keeping the read order among equal orders."""
+    # Heapify is linear, so the first item is yielded without sorting all of them first. The running index
+    # breaks ties, keeping equal dependency orders in the order they were read, like a stable sort.
+    sign = -1 if high_to_low else 1
+    heap = [(sign * item['dependency_order'], nn, item) for nn, item in enumerate(items)]
+    heapq.heapify(heap)
+
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+@lru_cache(maxsize=128)
+def _build_filter(deployment_id_str: str, scope_items: Tuple[Tuple[str, str], ...]):
+    """Filter matching records not marked with `deployment_id_str` whose attributes equal `scope_items`."""
+    clauses = [~Attr('deployment_id').eq(deployment_id_str)]
+    clauses.extend(Attr(kk).eq(vv) for kk, vv in scope_items)
+
+    # Combine pairwise, so the `And` tree is balanced rather than a chain as deep as the scope is large.
+    while len(clauses) > 1:
+        combined = [aa & bb for aa, bb in zip(clauses[::2], clauses[1::2])]
+        if len(clauses) % 2:
+            combined.append(clauses[-1])
+        clauses = combined
+    return clauses[0]
+
+
+@lru_cache(maxsize=None)
+def _session_for_profile(profile_name: str) -> boto3.Session:
+    """Shared session per profile; constructing one re-reads the AWS config and credential files."""
+    return boto3.Session(profile_name=profile_name)
+
+
 def unmarked(
         resources_by_zrn_table,
         scope: Mapping[str, str],
         deployment_id,
         high_to_low_dependency_order: bool,
+        index_name: Optional[str] = None,
+        index_ordered: bool = False,
 ) -> Iterable[AWSResource]:
-    import boto3
-    from boto3.dynamodb.conditions import Key, Attr
-
-    # TODO: use GSI query on manager
-    filter_expression = ~Attr('deployment_id').eq(str(deployment_id).lower())
-    for kk, vv in scope.items():
-        filter_expression &= Attr(kk).eq(vv)
-
-    response = resources_by_zrn_table.scan(FilterExpression=filter_expression, ConsistentRead=True)
+    """
+    Yields `(dependency_order, zrn, resource)` for the records in `scope` not marked with `deployment_id`.
+
+    :param index_name: name of a global secondary index on `resources_by_zrn_table` whose partition key is `manager`.
+        If given and `scope` has a `manager`, the records are read by querying that index instead of scanning the
+        whole table. Since GSI reads cannot be strongly consistent, each candidate is re-read from the table before
+        it is yielded, so that a record marked earlier in this deployment is never reported as unmarked.
+    :param index_ordered: whether the sort key of `index_name` is `dependency_order`. If so, the index returns the
+        records already ordered, and they are yielded page by page as they are read, instead of after all of them
+        have been read and sorted. The order is then only as fresh as the (eventually consistent) index.
+    """
+    deployment_id_str = str(deployment_id).lower()
+    use_index = index_name is not None and 'manager' in scope
+
+    # key attributes cannot appear in a query's filter expression
+    filter_expression = _build_filter(deployment_id_str, tuple(sorted(
+        (kk, vv) for kk, vv in scope.items() if not (use_index and kk == 'manager'))))
+
+    if use_index:
+        query_kwargs = {'ScanIndexForward': not high_to_low_dependency_order} if index_ordered else {}
+        candidates = _paginate(resources_by_zrn_table.query,
+                               IndexName=index_name,
+                               KeyConditionExpression=Key('manager').eq(scope['manager']),
+                               FilterExpression=filter_expression,
+                               **_projection(['zrn']),
+                               **query_kwargs)
+        items = _reread_candidates(resources_by_zrn_table, candidates, deployment_id_str)
+    else:
+        items = _paginate(resources_by_zrn_table.scan, FilterExpression=filter_expression, ConsistentRead=True,
+                          **_projection(_RECORD_ATTRIBUTES))
 
-    assert 'LastEvaluatedKey' not in response, textwrap.wrap(textwrap.dedent('''needs pagination, violating behavior 
-        specified in documentation at 
-        https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Scan.html#Scan.Pagination
-    '''))
+    if not (use_index and index_ordered):
+        items = _by_dependency_order(items, high_to_low_dependency_order)
 
-    for item in sorted(response['Items'], key=itemgetter('dependency_order'), reverse=high_to_low_dependency_order):
-        session = boto3.Session(profile_name=item['account_number'])
+    for item in items:
+        session = _session_for_profile(item['account_number'])
         resource = deserialize_resource(session, item['region_name'], item['type'], item['ztid'], item['index_id'])
         zrn = item['zrn']
         yield item['dependency_order'], zrn, resource
 
 
-def delete_with_zrn(resources_by_zrn_table, zrn: str, resource: AWSResource):
-    # TODO: combine with `delete_resource_nice`
+def run_wave(executor: Executor, fn: Callable, calls: Iterable[tuple]) -> List[Future]:
+    """
+    Runs `fn(*args)` on `executor` for each `args` in `calls`, and waits for all of them. Once one fails, the calls
+    that have not started yet are cancelled.
+    """
+    futures = [executor.submit(fn, *args) for args in calls]
+    _, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        wait(not_done)
+    return futures
+
+
+def first_error(futures: Iterable[Future]) -> Optional[BaseException]:
+    """Returns the exception of the first of `futures` that failed, skipping cancelled ones, or `None`."""
+    for future in futures:
+        if not future.cancelled() and future.exception() is not None:
+            return future.exception()
+
+
+def parallel_detach_policies(role: zaws_iam.Role, max_workers: int = 8):
+    """
+    Detaches the managed policies attached to `role` and deletes its inline policies, with up to `max_workers` calls
+    in flight at once, so that the role can be deleted.
+
+    A role that does not exist (anymore) has nothing to detach, so it is skipped, as is a policy that is detached or
+    deleted meanwhile.
+    """
+    client = role.service_client
+    no_such_entity = client.exceptions.NoSuchEntityException
+    try:
+        policy_arns = [policy['PolicyArn']
+                       for page in client.get_paginator('list_attached_role_policies').paginate(RoleName=role.name)
+                       for policy in page['AttachedPolicies']]
+        policy_names = [policy_name
+                        for page in client.get_paginator('list_role_policies').paginate(RoleName=role.name)
+                        for policy_name in page['PolicyNames']]
+    except no_such_entity:
+        return
+
+    calls = [partial(client.detach_role_policy, RoleName=role.name, PolicyArn=policy_arn)
+             for policy_arn in policy_arns]
+    calls.extend(partial(client.delete_role_policy, RoleName=role.name, PolicyName=policy_name)
+                 for policy_name in policy_names)
+
+    def run(call: Callable):
+        try:
+            call()
+        except no_such_entity:
+            pass
+
+    if len(calls) <= 1:
+        for call in calls:
+            run(call)
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as executor:
+            error = first_error(run_wave(executor, run, ((call,) for call in calls)))
+        if error is not None:
+            raise error
+
+
+def _delete_resource(resource: AWSResource):
     if isinstance(resource, zaws_iam.Role):
-        print('detaching policies')
-        resource.detach_all_policies()
+        logger.info('detaching policies')
+        parallel_detach_policies(resource)
     resource.delete(not_exists_ok=True)
-    resources_by_zrn_table.delete_item(Key=dict(zrn=zrn))
 
 
 def update_dependency_order(resources_by_zrn_table, zrn, dependency_order):
@@ -281,12 +677,27 @@ def update_dependency_order(resources_by_zrn_table, zrn, dependency_order):
     )
 
 
-def collect_garbage(resources_by_zrn_table, scope, deployment_id, max_marked_dependency_order, dry):
+# dependency order of a `(dependency_order, zrn, resource)` tuple yielded by `unmarked`
+_get_dependency_order = itemgetter(0)
+
+
+def collect_garbage(resources_by_zrn_table, scope, deployment_id, max_marked_dependency_order, dry,
+                    index_name: Optional[str] = None, max_workers: int = 16, index_ordered: bool = False):
+    """
+    Deletes the resources in `scope` that are not marked with `deployment_id`, or with `dry`, only reports them.
+
+    Resources with the same dependency order cannot depend on each other, so each such tier is deleted concurrently
+    with up to `max_workers` threads. A tier is finished before the next (lower) one starts.
+
+    `index_name` and `index_ordered` are passed to `unmarked`.
+    """
     _unmarked = partial(
         unmarked,
         resources_by_zrn_table=resources_by_zrn_table,
         scope=scope,
         deployment_id=deployment_id,
+        index_name=index_name,
+        index_ordered=index_ordered,
     )
 
     logger.info('collecting garbage{}'.format(' (dry)' if dry else ''))
@@ -294,12 +705,28 @@ def collect_garbage(resources_by_zrn_table, scope, deployment_id, max_marked_dep
     if dry:
         delta = None
         for dependency_order, zrn, resource in _unmarked(high_to_low_dependency_order=False):
-            print(f'would delete: {resource.name}(ztid={resource.ztid}) : {type(resource).__name__}')
-            print('updating dependency_orders')
+            logger.info('would delete: %s(ztid=%s) : %s', resource.name, resource.ztid, type(resource).__name__)
+            logger.info('updating dependency_orders')
             if delta is None:
                 delta = max_marked_dependency_order + 1 - dependency_order
             update_dependency_order(resources_by_zrn_table, zrn, dependency_order + delta)
     else:
-        for dependency_order, zrn, resource in _unmarked(high_to_low_dependency_order=True):
-            print(f'deleting: {resource.name}(ztid={resource.ztid}) : {type(resource).__name__}')
-            delete_with_zrn(resources_by_zrn_table, zrn, resource)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tiers = groupby(_unmarked(high_to_low_dependency_order=True), key=_get_dependency_order)
+            for dependency_order, tier in tiers:
+                zrns, calls = [], []
+                for _, zrn, resource in tier:
+                    logger.info('deleting: %s(ztid=%s) : %s', resource.name, resource.ztid, type(resource).__name__)
+                    zrns.append(zrn)
+                    calls.append((resource,))
+                futures = run_wave(executor, _delete_resource, calls)
+
+                # Table resources are not thread safe, so records are removed from this thread, and only for the
+                # resources that were actually deleted. The batch writer sends up to 25 deletions per request.
+                with resources_by_zrn_table.batch_writer() as batch:
+                    for future, zrn in zip(futures, zrns):
+                        if not future.cancelled() and future.exception() is None:
+                            batch.delete_item(Key={'zrn': zrn})
+                error = first_error(futures)
+                if error is not None:
+                    raise error
@@ -1,7 +1,10 @@
 import argparse
-from types import MappingProxyType
-from typing import Dict, Optional, Iterable, Mapping
-from toolz import assoc, merge
+import json
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Dict, Optional, Iterable, List, Mapping
 import uuid
 
 from zsec_aws_tools.basic import AWSResource, get_account_id
@@ -10,28 +13,87 @@ import zsec_aws_tools.iam as zaws_iam
 
 import logging
 
-from .deployment import collect_garbage
+from .deployment import (AWSResourceCollection, collect_garbage, first_error, parallel_detach_policies, run_wave,
+                         ztid_key)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# Held around `_account_id_for`. Records are built on worker threads, a cache miss creates an STS client from the
+# resource's session, which is not thread safe, and lru_cache does not serialize concurrent misses.
+_account_id_lock = threading.Lock()
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj).encode()
+
+
+# JSON encoder for the payloads sent to recorders without the `FunctionResource` codec; orjson, if it is installed,
+# encodes straight to bytes in C.
+_dumps = _json_dumps if orjson is None else orjson.dumps
+
+
+@lru_cache(maxsize=None)
+def _account_id_for(session) -> str:
+    """
+    Memoized `get_account_id`, so that the STS call is made once per session rather than once per resource.
+
+    Sessions hash by identity, and the cache holds a reference to each one, so a cached id cannot be reused by a
+    different session.
+    """
+    return get_account_id(session)
+
 
-def get_resource_meta_description(res) -> Dict[str, str]:
+@lru_cache(maxsize=4096)
+def get_zrn(account_number: str, region_name: str, ztid: uuid.UUID) -> str:
+    # `str` of a UUID is already lowercase.
+    return f'zrn:aws:{account_number}:{region_name}:{ztid}'
+
+
+@lru_cache(maxsize=None)
+def _qualname(cls: type) -> str:
+    """Dotted path of `cls`, as recorded in the `type` attribute of resource records."""
+    return f'{cls.__module__}.{cls.__name__}'
+
+
+def get_resource_meta_description(res, account_number: Optional[str] = None) -> Dict[str, str]:
+    """
+    :param account_number: account of `res`, if known. Otherwise it is looked up from `res.session`.
+    """
     if isinstance(res, AWSResource):
-        account_number = get_account_id(res.session)
-        zrn = f'zrn:aws:{account_number}:{res.region_name}:{str(res.ztid).lower()}'
-        return dict(
-            zrn=zrn,
-            account_number=account_number,
-            region_name=res.region_name,
-            ztid=str(res.ztid),
-            name=res.name,
-            index_id=res.index_id,
-            type='{}.{}'.format(type(res).__module__, type(res).__name__),
-        )
+        if account_number is None:
+            with _account_id_lock:
+                account_number = _account_id_for(res.session)
+        zrn = get_zrn(account_number, res.region_name, res.ztid)
+        return {
+            'zrn': zrn,
+            'account_number': account_number,
+            'region_name': res.region_name,
+            'ztid': str(res.ztid),
+            'name': res.name,
+            'index_id': res.index_id,
+            'type': _qualname(type(res)),
+        }
     else:
         raise NotImplementedError
 
 
+def _invoke_recorder(recorder: FunctionResource, payload: Mapping, record_async: bool):
+    """
+    Invokes `recorder` with `payload`, and returns its response. With `record_async`, the invocation is only queued
+    (`InvocationType='Event'`), so it returns as soon as Lambda accepts the event, and there is no response.
+    """
+    if record_async:
+        # The event response has no payload to decode, so the payload is encoded here instead of by `json_codec`.
+        recorder.invoke(json_codec=False, InvocationType='Event', Payload=_dumps(payload))
+    else:
+        return recorder.invoke(json_codec=True, Payload=payload)
+
+
 def put_resource_nice(
         manager,
         resource: AWSResource,
@@ -39,6 +101,8 @@ def put_resource_nice(
         force: bool,
         put_resource_record: Optional[FunctionResource],
         deployment_id: uuid.UUID,
+        record_async: bool = False,
+        account_number: Optional[str] = None,
 ):
     """
 
@@ -49,73 +113,84 @@ def put_resource_nice(
     :param force:
     :param put_resource_record:
     :param deployment_id:
+    :param record_async: whether to queue the record instead of waiting for `put_resource_record` to write it.
+    :param account_number: account of `resource`, if known; see `get_resource_meta_description`.
     :return:
     """
     if resource.config:
-        print(f'applying: {resource.name}(ztid={resource.ztid}) : {type(resource).__name__}')
+        logger.info('applying: %s(ztid=%s) : %s', resource.name, resource.ztid, type(resource).__name__)
         resource.put(force=force)
         if put_resource_record and put_resource_record.exists and resource.exists:
-            payload = merge(
-                get_resource_meta_description(resource),
-                dict(deployment_id=str(deployment_id).lower(),
-                     manager=manager,
-                     dependency_order=dependency_order))
-            resp = put_resource_record.invoke(json_codec=True, Payload=payload)
+            payload = {
+                **get_resource_meta_description(resource, account_number),
+                'deployment_id': str(deployment_id).lower(),
+                'manager': manager,
+                'dependency_order': dependency_order,
+            }
+            resp = _invoke_recorder(put_resource_record, payload, record_async)
 
             if resp:
-                print(resp)
+                logger.info('%s', resp)
 
 
 def delete_resource_nice(
         manager,
         resource: AWSResource,
         force: bool,
-        delete_resource_record: Optional[FunctionResource]
+        delete_resource_record: Optional[FunctionResource],
+        record_async: bool = False,
+        account_number: Optional[str] = None,
 ):
     if force:
         raise NotImplementedError('Need to implement manager check for delete.')
 
     if resource.exists:
         if isinstance(resource, zaws_iam.Role):
-            print('detaching policies')
-            resource.detach_all_policies()
-        print('deleting: ', resource)
+            logger.info('detaching policies')
+            parallel_detach_policies(resource)
+        logger.info('deleting: %s', resource)
         resource.delete()
 
         if delete_resource_record and delete_resource_record.exists and not resource.exists:
-            resp = delete_resource_record.invoke(json_codec=True,
-                                                 Payload=assoc(get_resource_meta_description(resource),
-                                                               'manager', manager))
+            resp = _invoke_recorder(delete_resource_record,
+                                    {**get_resource_meta_description(resource, account_number), 'manager': manager},
+                                    record_async)
             if resp:
-                print(resp)
+                logger.info('%s', resp)
     else:
-        print('does not exist: ', resource)
+        logger.info('does not exist: %s', resource)
 
 
-def handle_cli_command(
-        manager: str,
-        resources: Iterable[AWSResource],
-        support_gc: bool = False,
-        gc_scope: Mapping[str, str] = None,
-        put_resource_record: Optional[FunctionResource] = None,
-        delete_resource_record: Optional[FunctionResource] = None,
-        resources_by_zrn_table=None,
-):
+def _dependency_waves(resources: Iterable[AWSResource], dedup: bool = False) -> List[List[AWSResource]]:
     """
+    Groups `resources` into waves that only depend on earlier waves. Without dependency information, which only an
+    `AWSResourceCollection` has, every resource is its own wave.
 
-    :param manager: Used for "memory management" for resources.
-    :param resources: Resources to put.
-    :param support_gc: Whether to support garbage collection.
-    :param gc_scope: defines a filter on attributes of resources in order to be considered in-scope for this deployment.
-        This limits the garbage collection scope.
-        E.g. `{'manager': manager, 'account_number': '123456789000'}`
-        limit the GC scope to only resources with the specified manager and in the specified account.
-        Default is `None`. If scope is `None`, this function behaves as if scope were set to `{'manager': manager}`.
-    :param put_resource_record:
-    :param delete_resource_record:
-    :param resources_by_zrn_table:
-    :return:
+    With `dedup`, only the last of the resources sharing a ztid is kept, in the position of the first. Resources
+    without a ztid cannot be told apart by it, so they are all kept. Collections hold one resource per ztid already.
     """
+    if isinstance(resources, AWSResourceCollection):
+        return resources.dependency_waves()
+    else:
+        if dedup:
+            by_key = {}
+            for resource in resources:
+                key = ztid_key(resource.ztid)
+                # ztid-less resources are keyed by (None, id(resource)), so they are never deduplicated.
+                by_key[(key, id(resource)) if key is None else (key, None)] = resource
+            resources = by_key.values()
+        return [[resource] for resource in resources]
+
+
+def _run_waves(executor: ThreadPoolExecutor, fn, waves: Iterable[Iterable[tuple]]):
+    """Runs `fn` concurrently over each wave of calls in turn. After a failure, no further waves are started."""
+    for calls in waves:
+        error = first_error(run_wave(executor, fn, calls))
+        if error is not None:
+            raise error
+
+
+def _build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest='subparser_name')
     apply_parser = subparsers.add_parser('apply')
@@ -136,32 +211,109 @@ def handle_cli_command(
         subparser.add_argument('--dry-gc', action='store_true',
                                help='do not garbage collect, only report. If --only-ztids` is specified, this flag '
                                     'is redundant because GC will be skipped.')
+    return parser
+
+
+_PARSER = _build_parser()
+
+
+def _show_progress():
+    """
+    Prints this package's progress messages to stdout, as a deploy script run from the command line expects, unless
+    the application has configured logging for them already.
+    """
+    package_logger = logging.getLogger(__package__)
+    if not package_logger.hasHandlers():
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        package_logger.addHandler(handler)
+        if package_logger.level == logging.NOTSET:
+            package_logger.setLevel(logging.INFO)
+
+
+def handle_cli_command(
+        manager: str,
+        resources: Iterable[AWSResource],
+        support_gc: bool = False,
+        gc_scope: Mapping[str, str] = None,
+        put_resource_record: Optional[FunctionResource] = None,
+        delete_resource_record: Optional[FunctionResource] = None,
+        resources_by_zrn_table=None,
+        gc_index_name: Optional[str] = None,
+        max_workers: int = 16,
+        gc_index_ordered: bool = False,
+        argv: Optional[List[str]] = None,
+        dedup: bool = False,
+        record_async: bool = False,
+        account_number: Optional[str] = None,
+):
+    """
 
-    args = parser.parse_args()
+    :param manager: Used for "memory management" for resources.
+    :param resources: Resources to put. If this is an `AWSResourceCollection` completed from a
+        `PartialAWSResourceCollection`, resources of the same dependency wave are applied (or destroyed) concurrently,
+        and that wave is recorded as their `dependency_order`. Otherwise they are processed one at a time, in order.
+    :param support_gc: Whether to support garbage collection.
+    :param gc_scope: defines a filter on attributes of resources in order to be considered in-scope for this deployment.
+        This limits the garbage collection scope.
+        E.g. `{'manager': manager, 'account_number': '123456789000'}`
+        limit the GC scope to only resources with the specified manager and in the specified account.
+        Default is `None`. If scope is `None`, this function behaves as if scope were set to `{'manager': manager}`.
+    :param put_resource_record:
+    :param delete_resource_record:
+    :param resources_by_zrn_table:
+    :param gc_index_name: optional GSI on `resources_by_zrn_table` with partition key `manager`, used to find garbage
+        by query rather than by scanning the whole table. See `deployment.unmarked`.
+    :param max_workers: maximum number of resources to put or delete at once.
+    :param gc_index_ordered: whether the sort key of `gc_index_name` is `dependency_order`, which lets garbage be
+        deleted as the index is paged through rather than after all of it has been read.
+    :param argv: command line arguments to parse instead of `sys.argv[1:]`.
+    :param dedup: whether to drop resources with the same ztid as a later one in `resources` before doing anything.
+    :param record_async: whether to invoke the recorders asynchronously, without waiting for the records to be
+        written. Records then land eventually, so this cannot be combined with garbage collection, which relies on
+        the marks written during this deployment.
+    :param account_number: account that all of `resources` are in, if known, which saves looking it up from their
+        sessions when they are recorded.
+    :return:
+    """
+    args = _PARSER.parse_args(argv)
+    _show_progress()
     force = args.subparser_name in ('apply', 'destroy') and args.force
 
     want_gc = support_gc and not args.only_ztids
+    if record_async and want_gc:
+        raise ValueError('asynchronous recording cannot be combined with garbage collection')
 
-    resource: AWSResource
     deployment_id = args.deployment_id or uuid.uuid4()
-    nn = 0
-    if args.subparser_name == 'apply' or (args.subparser_name is None):
-        for nn, resource in enumerate(resources):
-            if not args.only_ztids or resource.ztid in args.only_ztids:
-                put_resource_nice(
-                    manager, resource,
-                    dependency_order=nn,
-                    force=force,
-                    put_resource_record=put_resource_record,
-                    deployment_id=deployment_id,
-                )
-
-    elif args.subparser_name == 'destroy':
-        for resource in resources:
-            if not args.only_ztids or resource.ztid in args.only_ztids:
-                delete_resource_nice(manager, resource, force=force, delete_resource_record=delete_resource_record)
-
-    max_marked_dependency_order = nn
+    # Materializes `resources`, so a generator is only walked once.
+    waves = _dependency_waves(resources, dedup=dedup)
+    # Keyed like the collections: ints hash without a call to `UUID.__hash__`, and resources without a ztid are
+    # simply not selected.
+    only = frozenset(map(ztid_key, args.only_ztids)) if args.only_ztids else None
+
+    def selected(resource: AWSResource) -> bool:
+        return only is None or ztid_key(resource.ztid) in only
+
+    # Resources completed from one collection share a boto3 Session, which is not thread safe. The workers only use
+    # the service clients that zsec_aws_tools resources create from it when they are constructed, on this thread,
+    # and boto3 clients are thread safe. The account id lookup, which does create a client later, is serialized.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if args.subparser_name == 'apply' or (args.subparser_name is None):
+            put = partial(put_resource_nice, manager, force=force, put_resource_record=put_resource_record,
+                          deployment_id=deployment_id, record_async=record_async, account_number=account_number)
+            _run_waves(executor, put, (
+                [(resource, dependency_order) for resource in wave if selected(resource)]
+                for dependency_order, wave in enumerate(waves)))
+
+        elif args.subparser_name == 'destroy':
+            delete = partial(delete_resource_nice, manager, force=force, delete_resource_record=delete_resource_record,
+                             record_async=record_async, account_number=account_number)
+            # dependents before their dependencies
+            _run_waves(executor, delete, (
+                [(resource,) for resource in wave if selected(resource)]
+                for wave in reversed(waves)))
+
+    max_marked_dependency_order = max(len(waves) - 1, 0)
 
     if support_gc:
         assert manager and resources_by_zrn_table
@@ -170,7 +322,8 @@ def handle_cli_command(
             if gc_scope is None:
                 gc_scope = {'manager': manager}
             collect_garbage(resources_by_zrn_table, gc_scope, deployment_id,
-                            max_marked_dependency_order, args.dry_gc)
+                            max_marked_dependency_order, args.dry_gc, index_name=gc_index_name,
+                            max_workers=max_workers, index_ordered=gc_index_ordered)
         else:
             print('no gc')
     else: